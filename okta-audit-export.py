@@ -1,19 +1,14 @@
 import os
+import stat
 import sys
 import json
-import re
-import urllib3
-import urllib.parse
 import time
 import argparse
-import datetime
+import concurrent.futures
+import signal
+import fcntl
 
-# Caoture the start time of the script so we can check for timeout
-STARTTIME = datetime.datetime.now()
-
-# Initialise the urllib3 pool manager, as we need it for all execution paths on
-# this function.
-HTTP = urllib3.PoolManager()
+from okta_client import HTTP, fetch_page, initial_url, request_headers
 
 CONFIG = [
     "okta-org-host",
@@ -24,9 +19,16 @@ CONFIG = [
 # Where to place the PID file
 PID_FILE = os.path.join(os.path.expanduser("~"), ".okta-to-humio.pid")
 
-# Maximum number of events to fetch from Okta per request
-# Cannot be more than 1000. Recommend 1000.
-OKTA_REQUEST_LIMIT = 1000
+# How many batches to process between checkpoints of the config file. The
+# config is also always written when the script exits.
+CHECKPOINT_INTERVAL = 10
+
+# Compact JSON encoder used to write each event as a single NDJSON line
+NDJSON_ENCODE = json.JSONEncoder(separators=(",", ":")).encode
+
+# The config as it was last read from or written to the config file, so that we can skip writing
+# it out again when nothing has changed
+LAST_WRITTEN_CONFIG = None
 
 
 def is_config(path):
@@ -48,16 +50,47 @@ def is_config(path):
 
 
 def load_config(path):
+    global LAST_WRITTEN_CONFIG
     with open(path) as config_f:
         # Load as JSON object
         config = json.load(config_f)
         config["config-file"] = path
+    LAST_WRITTEN_CONFIG = json.dumps(config, sort_keys=True)
     return config
 
 
 def write_config(path, config):
-    with open(path, "w") as config_f:
-        json.dump(config, config_f, indent=4, sort_keys=True)
+    """Writes the config to a temporary file and then moves it into place, so
+    that the checkpoint is never left half written. Nothing is written if the
+    config hasn't changed since it was last read or written."""
+    global LAST_WRITTEN_CONFIG
+    content = json.dumps(config, sort_keys=True)
+    if content == LAST_WRITTEN_CONFIG:
+        return
+
+    # The config holds the Okta API key, so the temporary file is only ever
+    # readable by us until it has been given the mode of the file it replaces
+    try:
+        mode = stat.S_IMODE(os.stat(path).st_mode)
+    except FileNotFoundError:
+        mode = 0o600
+
+    tmp_path = path + ".tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+    with os.fdopen(fd, "w") as config_f:
+        os.fchmod(config_f.fileno(), mode)
+        config_f.write(content)
+        config_f.flush()
+        os.fsync(config_f.fileno())
+    os.replace(tmp_path, path)
+    LAST_WRITTEN_CONFIG = content
+
+
+def exit_on_signal(signum, frame):
+    """Turns a termination signal into a normal exit so that the last
+    checkpoint is still written out"""
+    sys.stderr.write(f"Received signal {signum}, exiting.\n")
+    sys.exit(128 + signum)
 
 
 def setup_args():
@@ -79,29 +112,31 @@ def setup_args():
 
 
 def write_pid():
-    """Writes a PID to /var/run/okta-to-humio.pid
-    If the PID file already exists: return False
-    If the PID is created: return True
-    Any other error: undefined"""
+    """Writes a PID to the PID file and takes an exclusive lock on it.
+    If another copy of the script holds the lock: return None
+    If the lock is taken: return the open PID file, which must be kept open for as long as the
+    script runs. The kernel drops the lock when the process exits, however it exits, so there's
+    no stale PID file to clean up."""
 
-    # PID file already exists? We don't actually care if the PID matches because we only check this on startup
-    if os.path.isfile(PID_FILE):
-        return False
+    pid_f = open(PID_FILE, "a+")
+    try:
+        fcntl.flock(pid_f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except BlockingIOError:
+        pid_f.close()
+        return None
 
     # Get the PID
     pid = os.getpid()
     sys.stderr.write(f"The PID is: {pid}\n")
 
-    # Create the PID file
-    with open(PID_FILE, "w") as f:
-        f.write(f"{pid}\n")
-
-    # Everything went file, so ...
-    return True
+    # Replace whatever PID was left by the last run
+    pid_f.seek(0)
+    pid_f.truncate()
+    pid_f.write(f"{pid}\n")
+    pid_f.flush()
 
-
-def delete_pid():
-    os.remove(PID_FILE)
+    # Everything went fine, so ...
+    return pid_f
 
 
 def get_okta_url(config):
@@ -110,54 +145,19 @@ def get_okta_url(config):
         return config["continuation-url"]
     else:
         # This must be the first run, so start with the basic URL
-        return urllib.parse.urljoin(
-            config["okta-org-host"], f"api/v1/logs?limit={OKTA_REQUEST_LIMIT}"
-        )
-
+        return initial_url(config["okta-org-host"])
 
-def get_okta_logs(config):
-    """Fetches logs from Okta and returns the data (as a newline separated
-    string) and the continuation url."""
 
-    # Define the Okta request headers
-    okta_headers = {"Authorization": "SSWS " + config["okta-api-key"]}
-
-    # Get the messages from the Okta API
-    response = HTTP.request("GET", get_okta_url(config), headers=okta_headers)
-
-    # Parse the JSON content to single line messages
-    events = json.loads(response.data.decode("utf8"))
-
-    # Send the logs found to Humio, newline seperated
-    return events, get_next_url(response)
-
-
-def get_next_url(response):
-    """parses the "next" url from the okta response"""
-    try:
-        for link in response.headers["Link"].split(","):
-            if "next" in link:
-                url_match = re.search("<(https://.+)>;", link)
-                return url_match.group(1)
-    except KeyError as e:
-        error_response = json.loads(response.data.decode("utf8"))
-        if error_response["errorCode"] == "E0000047":
-            sys.stderr.write("ERROR: Okta API Rate Limit Exceeded, exiting.\n")
-        else:
-            sys.stderr.write("Unknown Error occured from Okta API, details:\n")
-            sys.stderr.write(response.data.decode("utf8"))
-            sys.stderr.write("\n")
-        sys.exit(1)
-    # No "next" link found (there should always be a next link!)
-    return None
+def write_ndjson(events):
+    """Writes the events to stdout as NDJSON in a single buffered write"""
+    lines = "".join(f"{NDJSON_ENCODE(event)}\n" for event in events)
+    sys.stdout.buffer.write(lines.encode("utf8"))
+    sys.stdout.buffer.flush()
 
 
 if __name__ == "__main__":
     """Running as a script"""
 
-    # Capture "now" so we can measure timeout
-    startTime = datetime.datetime.now()
-
     # Parse the command line arguments
     args = setup_args()
 
@@ -165,43 +165,71 @@ if __name__ == "__main__":
     config = load_config(args["config-file"])
     # sys.stderr.write(json.dumps(config, indent=4, sort_keys=True) + "\n")
 
+    # The headers for the Okta API stay the same for every request
+    okta_headers = request_headers(config["okta-api-key"])
+
+    # Work out when we have to stop so we can measure timeout. The monotonic clock is used so
+    # that the system clock being adjusted can't cut the run short or keep it going forever.
+    deadline = time.monotonic() + float(config["timeout"])
+
     # Write the PID file to make sure we know we're running
-    if not write_pid():
+    pid_f = write_pid()
+    if pid_f is None:
         sys.stderr.write(
-            f"It looks like this script is already running! If you are certain that is not the \
-case please delete the file {PID_FILE} and try again.\n"
+            f"It looks like this script is already running! The process holding the lock on \
+{PID_FILE} must exit before it can run again.\n"
         )
+        sys.exit(99)
 
-    # The main loop where we process batches of events from Okta so long as the timeout hasn't been reached
-    while datetime.datetime.now() < (
-        startTime + datetime.timedelta(seconds=config["timeout"])
-    ):
-        sys.stderr.write("Fetching events from Okta ...")
-        # Get a batch of Okta events
-        data, config["continuation-url"] = get_okta_logs(config)
-        sys.stderr.write(" %d events returned.\n" % len(data))
-
-        # If we didn't get any events then we're done with this run of the script
-        if len(data) == 0:
-            sys.stderr.write("No new audit messages to process, exiting.\n")
-            break
-
-        # Print events as NDJSON to stdout
-        sys.stderr.write("Printing %d events to stdout ..." % len(data))
-        for event in data:
-            sys.stdout.write(json.dumps(event))
-            sys.stdout.write("\n")
-        sys.stderr.write(" done.\n")
-
-        # Update the config with the latest checkpoint data
-        write_config(args["config-file"], config)
-
-        # If the last batch had < LIMIT number of events we can assume we're at the end of the
-        # audit log for now, so break rather than waste an API request
-        if len(data) < OKTA_REQUEST_LIMIT:
-            sys.stderr.write("Probably no new audit messages to process, exiting.\n")
-            break
+    # Make sure a scheduler timing us out still leaves the checkpoint behind
+    signal.signal(signal.SIGTERM, exit_on_signal)
 
-    # Finally write out the last version of the config and delete the PID and exit
-    write_config(args["config-file"], config)
-    delete_pid()
+    # The main loop where we process batches of events from Okta so long as the timeout hasn't been reached.
+    # The next batch is fetched in the background whilst the current one is printed, so that the
+    # time spent writing to stdout is hidden behind the Okta round-trip. The continuation url in
+    # the config only moves on once a batch has been printed.
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=1) as executor:
+            next_batch = executor.submit(
+                fetch_page, HTTP, get_okta_url(config), okta_headers, deadline
+            )
+            batches = 0
+            while next_batch is not None and time.monotonic() < deadline:
+                sys.stderr.write("Fetching events from Okta ...")
+                # Get a batch of Okta events
+                data, next_url = next_batch.result()
+                next_batch = None
+                sys.stderr.write(" %d events returned.\n" % len(data))
+
+                # If we didn't get any events then we're done with this run of the script
+                if len(data) == 0:
+                    if next_url is not None:
+                        config["continuation-url"] = next_url
+                    sys.stderr.write("No new audit messages to process, exiting.\n")
+                    break
+
+                # Okta only leaves out the "next" link once there are no more pages to fetch
+                if next_url is not None:
+                    next_batch = executor.submit(
+                        fetch_page, HTTP, next_url, okta_headers, deadline
+                    )
+
+                # Print events as NDJSON to stdout
+                sys.stderr.write("Printing %d events to stdout ..." % len(data))
+                write_ndjson(data)
+                sys.stderr.write(" done.\n")
+
+                # Update the config with the latest checkpoint data, writing it out every so often
+                # in case we don't get the chance to on exit
+                if next_url is not None:
+                    config["continuation-url"] = next_url
+                batches += 1
+                if batches % CHECKPOINT_INTERVAL == 0:
+                    write_config(args["config-file"], config)
+
+                if next_batch is None:
+                    sys.stderr.write("No more audit messages available from Okta, exiting.\n")
+
+    finally:
+        # Finally write out the last version of the config and exit, which releases the PID lock
+        write_config(args["config-file"], config)
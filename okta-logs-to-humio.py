@@ -1,18 +1,46 @@
 import os
 import sys
 import json
-import re
 import boto3
-import urllib3
 import urllib.parse
 import time
+import concurrent.futures
+import collections
 
+from okta_client import HTTP, RETRIES, USER_AGENT, fetch_page, initial_url, request_headers
 
-# Initialise the urllib3 pool manager, as we need it for all execution paths on
-# this function.
-# TODO: investigate how this persists in Lambda as it's outside the calling
-# function
-HTTP = urllib3.PoolManager()
+# Compact JSON encoder used for the Humio payloads, there's no need to send
+# the whitespace the default separators add
+HUMIO_ENCODE = json.JSONEncoder(separators=(',', ':')).encode
+
+# The DynamoDB client is created once so that warm starts of the function
+# reuse it, along with its connection pool
+DDB = boto3.client('dynamodb')
+
+# How many batches to send to Humio between writes of the continuation URL to
+# DynamoDB. The latest URL is also always written before the function returns.
+CHECKPOINT_INTERVAL = 5
+
+# Lambda doesn't warn the function before it times out, it just stops it, so
+# within this many seconds of the deadline the continuation URL is written
+# after every batch instead
+CHECKPOINT_MARGIN = 30
+
+# How many seconds before Lambda would time out the function stops fetching from
+# Okta. Neither the fetches nor the Humio POSTs start a retry past that point,
+# but a fetch that has just started can still take up to 15 seconds (its
+# connect and read timeouts) and the POST of that batch another 10, so this
+# leaves room for both and the last DynamoDB writes.
+STOP_MARGIN = 35
+
+# How many POSTs to Humio may be in flight at once
+HUMIO_MAX_IN_FLIGHT = 4
+
+# The configuration, database connection and Okta request headers, set up on
+# the first invocation and then reused by warm starts
+CONFIG = None
+DATABASE = None
+OKTA_HEADERS = None
 
 def load_configuration():
     """Read the configuration from the environment variables and return as a
@@ -29,88 +57,99 @@ def load_configuration():
 
 
 def setup_database_connection(config):
-    """Setup connections to the DynamoDB and return client, resource objects.
-    Checks that the database configured also exists and that we have write
-    access.
+    """Return the DynamoDB client used to store the continuation URL.
+    There's no up-front check of the table as that costs two round trips to
+    DynamoDB on every invocation; instead any problem reaching the table is
+    reported by the first real read in get_startup_url.
     TODO: This should do something useful if the database doesn't already
     exist."""
-    resource = boto3.resource('dynamodb')
-    client   = boto3.client('dynamodb')
+    return {'client': DDB}
+
+
+
+def database_error(error):
+    """Reports a failure to read from or write to DynamoDB and exits"""
+    sys.stderr.write("ERROR: The function failed to connect to DynamoDB. "
+                     "Please check the DynamoDB table name, and permissions.\n")
+    sys.stderr.write(str(error))
+    sys.exit()
+
+
 
+def get_startup_url(config, database):
+    """Retrieves the checkpoint url from the persistent storage (DynamoDB)"""
     try:
-        client.put_item(TableName=config['DDB_TABLE'],
-                        Item={'okta_org_url':   {'S': "TEST"},
-                              'last_query_url': {'S': "TEST"}})
-        client.get_item(TableName=config['DDB_TABLE'],
-                        Key={'okta_org_url': {'S': "TEST"}})
-        return {'client': client, 'resource': resource}
+        response = database['client'].get_item(TableName=config['DDB_TABLE'],
+                                               Key={'okta_org_url': {'S': config['OKTA_ORG_URL']}})
     except Exception as error:
-        sys.stderr.write("ERROR: The function failed to connect to DynamoDB. \
-                          Please check the DynamoDB table name, and \
-                          permissions.\n""")
-        sys.stderr.write(str(error))
-        sys.exit()
+        database_error(error)
 
+    if 'Item' in response:
+        # TODO: Should check that we got something sensible back from the
+        # database at this point before returning.
+        return response['Item']['last_query_url']['S']
 
+    # If we didn't get back an item from DynamoDB then this is the first run
+    return initial_url(config['OKTA_ORG_URL'])
 
-def get_okta_logs(url, okta_api_key):
-    """Fetches logs from Okta and returns the data (as a newline separated
-    string) and the continuation url."""
 
-    # Define the Okta request headers
-    okta_headers = {'Authorization': 'SSWS ' + okta_api_key}
 
-    # Get the messages from the Okta API
-    okta_api_response = HTTP.request('GET', url, headers=okta_headers)
+def record_continuation_url(config, database, continuation_url):
+    """Writes the continuation URL to the persistent storage (DynamoDB)"""
+    try:
+        database['client'].put_item(TableName=config['DDB_TABLE'],
+                                    Item={'okta_org_url':   {'S': config['OKTA_ORG_URL']},
+                                          'last_query_url': {'S': continuation_url}})
+    except Exception as error:
+        database_error(error)
 
-    # Parse the JSON content to single line messages
-    okta_msgs = json.loads(okta_api_response.data.decode('utf8'))
 
-    # Send the logs found to Humio, newline seperated
-    return okta_msgs, len(okta_msgs), get_next_url(okta_api_response)
 
+def send_to_humio(url, headers, data, deadline):
+    """Pushes a batch of Okta events to Humio using the structured ingest API.
+    No retry of the POST is started after the deadline."""
+    # Build the structured payload for Humio. The attributes are the Okta event
+    # itself rather than a copy, so each event is only serialised once. This is
+    # also smaller than the unstructured API, where every event would have to be
+    # sent as an escaped JSON string and the ingest token would need a parser.
+    events = [{'timestamp': event['published'], 'attributes': event} for event in data]
+    payload = [{'tags': {'source': 'okta-audit'}, 'events': events}]
 
+    response = HTTP.request('POST', url, body=HUMIO_ENCODE(payload).encode('utf-8'), timeout=5,
+                            headers=headers, retries=RETRIES.new(deadline=deadline))
 
-def get_next_url(response):
-    """parses the "next" url from the okta response"""
-    try:
-        for link in response.headers['Link'].split(','):
-            if "next" in link:
-                url_match = re.search('<(https://.+)>;', link)
-                return url_match.group(1)
-    except KeyError as e:
-        error_response = json.loads(response.data.decode('utf8'))
-        if error_response["errorCode"] == "E0000047":
-            sys.stderr.write("ERROR: Okta API Rate Limit Exceeded, exiting.\n")
-        else:
-            sys.stderr.write("Unknown Error occured from Okta API, details:\n")
-            sys.stderr.write(response.data.decode('utf8'))
-            sys.stderr.write("\n")
-        sys.exit(1)
-    # No "next" link found (there should always be a next link!)
-    return None
+    # Humio rejecting the batch is as much a failure as the POST timing out,
+    # the continuation URL must not move past events that aren't in Humio
+    if not 200 <= response.status < 300:
+        raise RuntimeError(f"Humio returned HTTP {response.status}: "
+                           + response.data.decode('utf8', 'replace'))
 
 
 
-def get_startup_url(config, database):
-    """Retrieves the checkpoint url from the persistent storage (DynamoDB)"""
-    response = database['client'].get_item(TableName=config['DDB_TABLE'],
-                                           Key={'okta_org_url': {'S': config['OKTA_ORG_URL']}})
-    if 'Item' in response:
-        # TODO: Should check that we got something sensible back from the
-        # database at this point before returning.
-        return response['Item']['last_query_url']['S']
+def wait_for_humio(pending_post):
+    """Waits for an in-flight Humio POST to complete and returns the
+    continuation URL that is now safe to record"""
+    post, continuation_url = pending_post
+    try:
+        post.result()
+    except Exception as error:
+        # Attempt to send the data to Humio failed, either in the timeout
+        # specified or with an error status. So we need to abort at this
+        # point and not record the continuation url
+        sys.stderr.write("ERROR: Sending data to Humio failed, aborting.\n")
+        sys.stderr.write(str(error) + "\n")
+        sys.exit(2)
 
-    # If we didn't get back an item from DynamoDB then this is the first run
-    return urllib.parse.urljoin(config['OKTA_ORG_URL'], "api/v1/logs?limit=100")
+    return continuation_url
 
 
 
-def record_continuation_url(config, database, continuation_url):
-    """Writes the continuation URL to the persistent storage (DynamoDB)"""
-    database['client'].put_item(TableName=config['DDB_TABLE'],
-                                Item={'okta_org_url':   {'S': config['OKTA_ORG_URL']},
-                                      'last_query_url': {'S': continuation_url}})
+def record_checkpoint(config, database, checkpoint_url, last_written_url):
+    """Writes the checkpoint URL to DynamoDB if it has moved on since it was
+    last written, and returns the URL that is now recorded"""
+    if checkpoint_url != last_written_url:
+        record_continuation_url(config, database, checkpoint_url)
+    return checkpoint_url
 
 
 
@@ -122,58 +161,91 @@ def lambda_handler(event=None, context=None):
         sys.stderr.write("ERROR: This function must have a timeout >= 1 minute\n")
         sys.exit(1)
 
-    # Read the configuration
-    config = load_configuration()
-
-    # And assume a full response before we start
-    response_length = 100
-
-    # Get the database connection
-    database = setup_database_connection(config)
+    # Read the configuration and get the database connection, unless a
+    # previous invocation in this container already has
+    global CONFIG, DATABASE, OKTA_HEADERS
+    if CONFIG is None:
+        CONFIG = load_configuration()
+        DATABASE = setup_database_connection(CONFIG)
+        OKTA_HEADERS = request_headers(CONFIG['OKTA_API_KEY'])
+    config, database = CONFIG, DATABASE
 
     # Check to see if this is a cold or warm start
     okta_url = get_startup_url(config, database)
 
     # Prepare the Humio headers and URL
     humio_headers = {'Authorization': 'Bearer ' + config['HUMIO_TOKEN'],
-                     'Content-Type':  'application/json'}
+                     'Content-Type':  'application/json',
+                     'User-Agent':    USER_AGENT}
     humio_structured_url = urllib.parse.urljoin(config['HUMIO_SERVER'], "/api/v1/ingest/humio-structured")
 
-    # Whilst there's at least 10 seconds left before this lambda call times out
-    # and we haven't reached the end of the available records from the okta api
-    # we fetch logs and send them to Humio, keeping track of the last URL
-    # used in DynamoDB
-    while context.get_remaining_time_in_millis() > 15000 and response_length == 100:
-
-        # Read the data from Okta
-        data, response_length, okta_url = get_okta_logs(okta_url, config['OKTA_API_KEY'])
-
-        # If there's no results to process then we can exit and be done
-        if response_length == 0:
-            sys.stderr.write("INFO: No new audit messages to process, exiting.\n")
-            return None
-
-        # Build the structured payload for Humio
-        payload = [{'tags': {'source': 'okta-audit'}, 'events': []}]
-        for event in data:
-            payload[0]['events'].append({'timestamp': event['published'],
-                                         'attributes': event})
+    # Work out when we need to stop, leaving STOP_MARGIN seconds before this
+    # lambda call times out, against the monotonic clock so the loop doesn't
+    # have to ask the context for the remaining time on every pass
+    deadline = time.monotonic() + context.get_remaining_time_in_millis() / 1000 - STOP_MARGIN
 
+    # Whilst there's at least STOP_MARGIN seconds left before this lambda call times out
+    # and Okta has given us a "next" link to the rest of the records
+    # we fetch logs and send them to Humio, keeping track of the last URL
+    # used in DynamoDB. Up to HUMIO_MAX_IN_FLIGHT POSTs to Humio run in the
+    # background whilst the next batches are fetched from Okta, and the
+    # continuation URL only moves on past a batch once it and every batch
+    # before it have been sent. It is written to DynamoDB for a warm
+    # restart every few batches, after every batch as the deadline gets close,
+    # and before the function returns or exits on an error.
+    checkpoint_url = last_written_url = okta_url
+    batches = 0
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=HUMIO_MAX_IN_FLIGHT) as executor:
+            pending_posts = collections.deque()
+            while time.monotonic() < deadline and okta_url is not None:
+
+                # Read the data from Okta
+                data, okta_url = fetch_page(HTTP, okta_url, OKTA_HEADERS, deadline)
+
+                # Collect the batches that are already in Humio, oldest first,
+                # waiting on the oldest if there are too many still in flight
+                while pending_posts and (pending_posts[0][0].done() or
+                                         len(pending_posts) >= HUMIO_MAX_IN_FLIGHT):
+                    # Okta leaves out the "next" link once there are no more
+                    # pages, in which case we stay on the last URL we had
+                    checkpoint_url = wait_for_humio(pending_posts.popleft()) or checkpoint_url
+                    batches += 1
+                    if (batches % CHECKPOINT_INTERVAL == 0 or
+                            time.monotonic() > deadline - CHECKPOINT_MARGIN):
+                        last_written_url = record_checkpoint(config, database, checkpoint_url,
+                                                             last_written_url)
+
+                # If there's no results to process then we can exit and be done
+                if len(data) == 0:
+                    sys.stderr.write("INFO: No new audit messages to process, exiting.\n")
+                    break
+
+                # Push the data to Humio
+                pending_posts.append((executor.submit(send_to_humio, humio_structured_url, humio_headers, data,
+                                                      deadline),
+                                      okta_url))
+
+                # Slow down the request rate to Okta as it will complain if too
+                # quick, but not past the deadline
+                pause = min(5, deadline - time.monotonic())
+                if pause > 0:
+                    time.sleep(pause)
+
+            # Everything we've fetched must be in Humio before we finish
+            while pending_posts:
+                checkpoint_url = wait_for_humio(pending_posts.popleft()) or checkpoint_url
+                last_written_url = record_checkpoint(config, database, checkpoint_url,
+                                                     last_written_url)
+
+        record_checkpoint(config, database, checkpoint_url, last_written_url)
+
+    except BaseException:
+        # Record how far we got before passing the error on. If DynamoDB fails
+        # too then database_error has already reported it, and the original
+        # error still decides how the function exits.
         try:
-            # Push the data to Humio
-            HTTP.request('POST', humio_structured_url, body=json.dumps(payload).encode('utf-8'), timeout=5, headers=humio_headers)
-
-            # Record the continuation URL in DynamoDB for a warm restart
-            record_continuation_url(config, database, okta_url)
-
-        except Exception as error:
-            # TODO: This needs to capture more/all error conditions from the POST
-            # Attempt to send the data to Humio failed in the timeout specified.
-            # So we need to abort at this point and not record the continuation
-            # url
-            sys.stderr.write("ERROR: Sending data to Humio timed out, aborting.\n")
-            sys.stderr.write(str(error))
-            sys.exit(2)
-
-        # Slow down the request rate to Okta as it will complain if too quick
-        time.sleep(5)
+            record_checkpoint(config, database, checkpoint_url, last_written_url)
+        except SystemExit:
+            pass
+        raise
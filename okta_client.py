@@ -0,0 +1,163 @@
+"""Fetching of audit events from the Okta System Log API, shared by the Lambda
+function (okta-logs-to-humio.py) and the export script (okta-audit-export.py)."""
+import sys
+import json
+import time
+import urllib3
+import urllib.parse
+
+
+# The longest we'll wait for an Okta rate limit to reset before retrying, whatever Okta asks for.
+# Okta's limits are counted per minute, so the reset is never further away than this.
+MAX_RATE_LIMIT_WAIT = 60
+
+# The longest backoff before retrying after any other transient error
+MAX_BACKOFF_WAIT = 5
+
+# How long to wait for Okta to accept the connection and then for each read of the response.
+# Timeouts are retried like any other transient error.
+OKTA_TIMEOUT = urllib3.Timeout(connect=5, read=10)
+
+
+class OktaRetry(urllib3.Retry):
+    """Retry policy that also honours Okta's X-Rate-Limit-Reset header. Okta
+    doesn't send Retry-After when it rate limits a request, instead it gives the
+    time (in seconds since the epoch) at which the limit resets.
+    Waits for the rate limit are capped at MAX_RATE_LIMIT_WAIT seconds and
+    other backoffs at MAX_BACKOFF_WAIT seconds. If a deadline (against
+    time.monotonic) is given then no wait runs past it and no retry starts after
+    it, so that a rate limited request can't keep the caller past its timeout."""
+
+    def __init__(self, *args, deadline=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.deadline = deadline
+
+    def new(self, **kwargs):
+        kwargs.setdefault("deadline", self.deadline)
+        return super().new(**kwargs)
+
+    def limit_wait(self, wait, ceiling):
+        wait = min(wait, ceiling)
+        if self.deadline is not None:
+            wait = min(wait, self.deadline - time.monotonic())
+        return max(wait, 0)
+
+    def get_retry_after(self, response):
+        retry_after = super().get_retry_after(response)
+        if retry_after is None and response.status == 429:
+            try:
+                reset = float(response.headers["X-Rate-Limit-Reset"])
+            except (KeyError, ValueError):
+                return None
+            retry_after = reset - time.time()
+        if retry_after is None:
+            return None
+        return self.limit_wait(retry_after, MAX_RATE_LIMIT_WAIT)
+
+    def get_backoff_time(self):
+        return self.limit_wait(super().get_backoff_time(), MAX_BACKOFF_WAIT)
+
+    def is_exhausted(self):
+        if self.deadline is not None and time.monotonic() >= self.deadline:
+            return True
+        return super().is_exhausted()
+
+
+# The retry policy for every request. Rate limited requests wait until Okta says the limit
+# resets and other transient errors are retried with a backoff, all on the same connection.
+# Once the retries are used up the last response is returned so that the error handling below
+# still applies.
+RETRIES = OktaRetry(
+    total=3,
+    backoff_factor=0.5,
+    status_forcelist=(429, 500, 502, 503, 504),
+    respect_retry_after_header=True,
+    raise_on_status=False,
+)
+
+# Initialise the urllib3 pool manager, as we need it for all execution paths.
+# The pool is sized so that the connections to both Okta and Humio, along with
+# the background fetch of the next batch, can be kept alive.
+HTTP = urllib3.PoolManager(num_pools=4, maxsize=8, retries=RETRIES)
+
+# Sent with every request to Okta and Humio. urllib3 only uses pool level headers for requests
+# that don't pass their own, so this has to go in each request's headers.
+USER_AGENT = "okta-to-humio/1.0"
+
+# Maximum number of events to fetch from Okta per request
+# Cannot be more than 1000. Recommend 1000.
+OKTA_REQUEST_LIMIT = 1000
+
+
+def initial_url(org, limit=OKTA_REQUEST_LIMIT):
+    """Returns the URL to start from when there is no continuation url yet"""
+    return urllib.parse.urljoin(org, f"api/v1/logs?limit={limit}")
+
+
+def request_headers(api_key):
+    """Returns the headers for requests to the Okta API. These don't change
+    between requests, so build them once and pass them in to fetch_page. Okta
+    will gzip the response, which urllib3 decodes for us."""
+    return {
+        "Authorization": "SSWS " + api_key,
+        "Accept": "application/json",
+        "Accept-Encoding": "gzip",
+        "User-Agent": USER_AGENT,
+    }
+
+
+def fetch_page(http, url, okta_headers, deadline=None):
+    """Fetches a page of logs from Okta and returns the events and the
+    continuation url. Retries stop at the deadline (against time.monotonic),
+    if one is given."""
+
+    # Get the messages from the Okta API. urllib3 reads the whole body before returning, which
+    # also puts the connection back in the pool ready for the next request.
+    response = http.request(
+        "GET",
+        url,
+        headers=okta_headers,
+        retries=RETRIES.new(deadline=deadline),
+        timeout=OKTA_TIMEOUT,
+    )
+
+    # If we're still rate limited after all the retries then stop here, so that the caller can
+    # record where it got to before exiting
+    if response.status == 429:
+        sys.stderr.write("ERROR: Okta API Rate Limit Exceeded, stopping.\n")
+        return [], None
+    if not 200 <= response.status < 300:
+        okta_error(response)
+
+    # Parse the JSON content to single line messages
+    events = json.loads(response.data)
+
+    return events, get_next_url(response.headers.get("Link"))
+
+
+def okta_error(response):
+    """Reports an error response from the Okta API and exits"""
+    sys.stderr.write("Unknown Error occured from Okta API, details:\n")
+    sys.stderr.write(response.data.decode("utf8", "replace"))
+    sys.stderr.write("\n")
+    sys.exit(1)
+
+
+def get_next_url(header):
+    """parses the "next" url from the Link header of an okta response"""
+    if header is None:
+        return None
+
+    # The header holds one or more comma separated links of the form
+    # <https://...>; rel="next", so find the "next" one and take the URL
+    # from between its angle brackets
+    for link in header.split(","):
+        if 'rel="next"' not in link:
+            continue
+        start = link.find("<")
+        end = link.find(">", start + 1)
+        if start >= 0 and end > start:
+            return link[start + 1:end]
+
+    # No "next" link found, so there are no more pages to fetch
+    return None